@@ -2,18 +2,25 @@
 # Copyright © 2024 Nicolas Graves <ngraves@ngraves.fr>
 
 import hashlib
-import io
 import logging
 import os
 import re
+import shlex
 import subprocess
 import sys
-from pathlib import Path
+import tempfile
+import time
+from functools import lru_cache
 from typing import Any, IO, Dict, Iterable, Iterator, Mapping, Optional, Tuple, Union
 from IPython.core.magic import Magics, line_magic, magics_class  # type: ignore
 from IPython.core.magic_arguments import (argument, magic_arguments,  # type: ignore
                                           parse_argstring)  # type: ignore
 
+try:
+    import xxhash  # type: ignore
+except ImportError:
+    xxhash = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -23,76 +30,157 @@ logger = logging.getLogger(__name__)
 # https://github.com/python/typeshed/pull/6832.
 StrPath = Union[str, "os.PathLike[str]"]
 
-env_var_pattern = re.compile(r'declare -x (\w+)="(.*)"')
+# Resolved once at import; expanduser leaves "~" as is if there is no home.
+_XDG_DATA_HOME = os.environ.get("XDG_DATA_HOME") or os.path.expanduser(
+    "~/.local/share"
+)
+# Where direnv records allowed files, named after their hash.
+_ALLOW_DIR = os.path.join(_XDG_DATA_HOME, "direnv", "allow")
+_ALLOW_XXH3_DIR = os.path.join(_XDG_DATA_HOME, "direnv", "allow_xxh3")
 
+# Files changed less than this many nanoseconds ago aren't cached, as the
+# coarsest timestamps (e.g. FAT's) have a 2 seconds granularity.
+_RACY_NS = 2 * 10**9
 
-def _direnv_file_hash(path):
+# Characters that `declare -x` escapes in double-quoted values.
+_escaped_char = re.compile(rb'\\([\\"$`])')
+
+# Variables set by the bash subshell itself, not by the .envrc file.
+_BORING = frozenset(("OLDPWD", "PWD", "SHLVL", "_"))
+
+
+def _use_xxh3():
     """
-    Returns the direnv hash of a file.
+    Whether DIRENV_HASH=xxh3 opts in to the (non-cryptographic) xxh3 family.
+
+    xxh3 gives up tamper detection, and direnv itself never records xxh3
+    hashes: allow_xxh3/ is populated by hand. Without xxhash, SHA-256 is used.
     """
-    abs_path = os.path.abspath(path)
-    with open(abs_path, "r", encoding="utf-8") as f:
-        content = f.read()
-    input_data = f"{abs_path}\n{content}"
-    hasher = hashlib.sha256()
-    hasher.update(input_data.encode("utf-8"))
-    return hasher.hexdigest()
+    return xxhash is not None and os.environ.get("DIRENV_HASH") == "xxh3"
 
 
-def _xdg_data_home():
-    if value := os.environ.get("XDG_DATA_HOME"):
-        return value
+def _hash_file(abs_path, xxh3):
+    """
+    Hashes abs_path the way direnv does.
+    """
+    if xxh3:
+        hasher = xxhash.xxh3_128()
     else:
-        return str(Path.home() / ".local/share")
+        hasher = hashlib.sha256()
+    hasher.update(os.fsencode(abs_path) + b"\n")
+    with open(abs_path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):
+            hashlib.file_digest(f, lambda: hasher)
+        else:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+@lru_cache(maxsize=256)
+def _cached_file_hash(abs_path, mtime_ns, ctime_ns, ino, size, xxh3):
+    """
+    Hashes abs_path; the stat fields only key the cache.
+    """
+    return _hash_file(abs_path, xxh3)
+
+
+def _direnv_file_hash(path):
+    """
+    Returns the direnv hash of a file.
+    """
+    abs_path = os.path.abspath(path)
+    stat = os.stat(abs_path)
+    xxh3 = _use_xxh3()
+    # Like git's "racily clean" entries: within the filesystem's timestamp
+    # granularity, a same-size edit can keep the same stat, so recently
+    # changed files are always hashed again.
+    if time.time_ns() - max(stat.st_mtime_ns, stat.st_ctime_ns) < _RACY_NS:
+        return _hash_file(abs_path, xxh3)
+    return _cached_file_hash(
+        abs_path,
+        stat.st_mtime_ns,
+        stat.st_ctime_ns,
+        stat.st_ino,
+        stat.st_size,
+        xxh3,
+    )
 
 
 def _is_allowed(path):
     """
     Checks that direnv allows the execution of file.
     """
-    file_hash_value = _direnv_file_hash(path)
-    allowed_file_path = os.path.join(
-        _xdg_data_home(), "direnv", "allow", file_hash_value
-    )
-    if os.path.exists(allowed_file_path):
-        with open(allowed_file_path, "r", encoding="utf-8") as f:
-            real_path = f.read().strip()
-            return os.path.realpath(path) == real_path
-    return False
+    allow_dir = _ALLOW_XXH3_DIR if _use_xxh3() else _ALLOW_DIR
+    if not os.path.isabs(allow_dir):
+        # Without XDG_DATA_HOME nor a home directory, "~" isn't expanded: never
+        # look the database up relative to the working directory.
+        logger.warning(f"Cannot locate direnv's allow directory: '{allow_dir}'")
+        return False
+    allowed_file_path = os.path.join(allow_dir, _direnv_file_hash(path))
+    try:
+        fd = os.open(allowed_file_path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        # A path and its newline fit in PATH_MAX (4096) bytes.
+        real_path = os.fsdecode(os.read(fd, 4096)).strip()
+    finally:
+        os.close(fd)
+    return os.path.realpath(path) == real_path
 
 
 def _parse_bash_env(
-    stream: io.StringIO, encoding: Optional[str] = "utf-8"
+    stream: Iterable[bytes], encoding: str = "utf-8"
 ) -> Iterator[Tuple[str, Optional[str]]]:
     """
     Parses the stream and yields key-value pairs.
     """
+    prefix = b"declare -x "
     for line_num, line in enumerate(stream, 1):
         line = line.strip()
-        match = env_var_pattern.match(line)
-        if match:
-            key = match.group(1)
-            value = match.group(2)
-            yield key, value
-        else:
-            logger.warning(f"Could not parse statement on line {line_num}: '{line}'")
-
-
-def _direnv_as_stream(path):
+        if line.startswith(prefix):
+            eq = line.find(b"=", len(prefix))
+            if eq < 0:
+                # Exported variable without a value, e.g. `declare -x OLDPWD`.
+                yield line[len(prefix):].decode(encoding), None
+                continue
+            if len(line) > eq + 2 and line[eq + 1] == ord('"') and line.endswith(b'"'):
+                key = line[len(prefix):eq].decode(encoding)
+                value = line[eq + 2:-1]
+                if b"\\" in value:
+                    value = _escaped_char.sub(rb"\1", value)
+                yield key, value.decode(encoding)
+                continue
+        logger.warning(
+            f"Could not parse statement on line {line_num}: "
+            f"'{line.decode(encoding, 'replace')}'"
+        )
+
+
+def _direnv_as_stream(path) -> Iterator[bytes]:
     """
-    Sources the .envrc file, output environment as a stream.
+    Sources the .envrc file, output environment as a stream of lines.
     """
-    file_path = os.path.abspath(path)
-    result = subprocess.run(
-        f"source {file_path} 2>&1 && declare -x",
-        capture_output=True,
+    file_path = os.fspath(path)
+    if not os.path.isabs(file_path):
+        file_path = os.path.abspath(file_path)
+    # A temporary file rather than a pipe for stderr, so that a noisy .envrc
+    # can't block bash while we are still reading its stdout.
+    with tempfile.TemporaryFile() as stderr, subprocess.Popen(
+        ["bash", "-c", f"source {shlex.quote(file_path)} && declare -x"],
+        stdout=subprocess.PIPE,
+        stderr=stderr,
         cwd=os.path.dirname(file_path),
-        shell=True,
-        text=True,
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"Failed to source {path}: {result.stderr}")
-    return io.StringIO(result.stdout)
+        env=os.environ,
+    ) as proc:
+        assert proc.stdout is not None
+        yield from proc.stdout
+        if proc.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError(
+                f"Failed to source {path}: {stderr.read().decode(errors='replace')}"
+            )
 
 
 # This function is copied from https://github.com/theskumar/python-dotenv
@@ -114,7 +202,7 @@ def _walk_to_root(path: str) -> Iterator[str]:
     current_dir = os.path.abspath(path)
     while last_dir != current_dir:
         yield current_dir
-        parent_dir = os.path.abspath(os.path.join(current_dir, os.path.pardir))
+        parent_dir = os.path.dirname(current_dir)
         last_dir, current_dir = current_dir, parent_dir
 
 
@@ -147,16 +235,20 @@ def find_direnv(
         path = os.getcwd()
     else:
         # will work for .py files
-        frame = sys._getframe()
-        current_file = __file__
-
-        while frame.f_code.co_filename == current_file or not os.path.exists(
-            frame.f_code.co_filename
-        ):
-            assert frame.f_back is not None
+        frame = sys._getframe(1)
+        while frame is not None:
+            frame_filename = frame.f_code.co_filename
+            # Pseudo-filenames such as <stdin> or <frozen ...> never exist.
+            if (
+                frame_filename != __file__
+                and not frame_filename.startswith("<")
+                and os.path.exists(frame_filename)
+            ):
+                path = os.path.dirname(os.path.abspath(frame_filename))
+                break
             frame = frame.f_back
-        frame_filename = frame.f_code.co_filename
-        path = os.path.dirname(os.path.abspath(frame_filename))
+        else:
+            path = os.getcwd()
 
     for dirname in _walk_to_root(path):
         check_path = os.path.join(dirname, filename)
@@ -211,12 +303,15 @@ def direnv_values(
     elif not _is_allowed(dotenv_path):
         raise PermissionError(f"File {dotenv_path} is not allowed by direnv.")
 
-    env_dict_items = _parse_bash_env(_direnv_as_stream(find_direnv(dotenv_path)))
+    env_dict_items = _parse_bash_env(_direnv_as_stream(dotenv_path))
+    # Bound to a plain dict snapshot, as os.environ.get encodes the key and
+    # decodes the value on every call.
+    env_get = dict(os.environ).get
 
     return {
         key: value
         for key, value in env_dict_items
-        if key not in ["OLDPWD", "PWD", "SHLVL", "_"] and os.environ.get(key) != value
+        if key not in _BORING and env_get(key) != value
     }
 
 
@@ -258,11 +353,10 @@ def load_direnv(
         interpolate=interpolate,
         encoding=encoding,
     )
-    for k, v in env_dict.items():
-        if k in os.environ and not override:
-            continue
-        if v is not None:
-            os.environ[k] = v
+    existing = {} if override else os.environ
+    os.environ.update(
+        {k: v for k, v in env_dict.items() if v is not None and k not in existing}
+    )
 
     return True
 
@@ -8,6 +8,14 @@ def dotenv_path(tmp_path):
     yield path
 
 
+@pytest.fixture
+def allow_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'allow'
+    path.mkdir()
+    monkeypatch.setattr("direnv._ALLOW_DIR", str(path))
+    yield path
+
+
 @pytest.fixture
 def direnv_allow(monkeypatch):
     monkeypatch.setattr("direnv._is_allowed", lambda _: True)
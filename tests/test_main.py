@@ -1,3 +1,4 @@
+import hashlib
 import io
 import logging
 import os
@@ -5,6 +6,7 @@ import pytest
 import subprocess
 import sys
 import textwrap
+import types
 from unittest import mock
 
 import direnv
@@ -29,6 +31,22 @@ def prepare_file_hierarchy(path):
     return leaf
 
 
+def test_walk_to_root(tmp_path):
+    leaf = prepare_file_hierarchy(tmp_path)
+
+    result = list(direnv._walk_to_root(str(leaf)))
+
+    assert result[:5] == [
+        str(leaf),
+        str(leaf.parent),
+        str(leaf.parent.parent),
+        str(tmp_path / "child1"),
+        str(tmp_path),
+    ]
+    assert result[-1] == os.path.sep
+    assert len(result) == len(leaf.parts)
+
+
 def test_find_direnv_no_file_raise(tmp_path):
     leaf = prepare_file_hierarchy(tmp_path)
     os.chdir(leaf)
@@ -57,6 +75,201 @@ def test_find_direnv_found(tmp_path):
     assert result == str(dotenv_path)
 
 
+def test_find_direnv_closer_file_created(tmp_path):
+    leaf = prepare_file_hierarchy(tmp_path)
+    os.chdir(leaf)
+    (tmp_path / ".envrc").write_bytes(b"TEST=test\n")
+    assert direnv.find_direnv(usecwd=True) == str(tmp_path / ".envrc")
+    dotenv_path = leaf.parent / ".envrc"
+    dotenv_path.write_bytes(b"TEST=test\n")
+
+    result = direnv.find_direnv(usecwd=True)
+
+    assert result == str(dotenv_path)
+
+
+def test_find_direnv_removed_file(tmp_path):
+    leaf = prepare_file_hierarchy(tmp_path)
+    os.chdir(leaf)
+    dotenv_path = tmp_path / ".envrc"
+    dotenv_path.write_bytes(b"TEST=test\n")
+    assert direnv.find_direnv(usecwd=True) == str(dotenv_path)
+    dotenv_path.unlink()
+
+    result = direnv.find_direnv(usecwd=True)
+
+    assert result == ""
+
+
+def test_direnv_file_hash(tmp_path):
+    dotenv_path = tmp_path / ".envrc"
+    dotenv_path.write_bytes(b"export a=b\r\n")
+    expected = hashlib.sha256(f"{dotenv_path}\n".encode() + b"export a=b\r\n")
+
+    result = direnv._direnv_file_hash(dotenv_path)
+
+    assert result == expected.hexdigest()
+
+
+def test_direnv_file_hash_modified_file(tmp_path):
+    dotenv_path = tmp_path / ".envrc"
+    dotenv_path.write_bytes(b"export a=b\n")
+    first = direnv._direnv_file_hash(dotenv_path)
+    dotenv_path.write_bytes(b"export a=bc\n")
+    expected = hashlib.sha256(f"{dotenv_path}\n".encode() + b"export a=bc\n")
+
+    result = direnv._direnv_file_hash(dotenv_path)
+
+    assert result != first
+    assert result == expected.hexdigest()
+
+
+def test_direnv_file_hash_same_size_edit(tmp_path):
+    dotenv_path = tmp_path / ".envrc"
+    dotenv_path.write_bytes(b"export a=b\n")
+    stat = dotenv_path.stat()
+    first = direnv._direnv_file_hash(dotenv_path)
+    dotenv_path.write_bytes(b"export a=c\n")
+    # Simulate a filesystem whose timestamps didn't move between both writes.
+    os.utime(dotenv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    result = direnv._direnv_file_hash(dotenv_path)
+
+    assert result != first
+
+
+def test_direnv_file_hash_cached(tmp_path, monkeypatch):
+    # The file's ctime can't be moved back, so treat no change as recent.
+    monkeypatch.setattr("direnv._RACY_NS", 0)
+    dotenv_path = tmp_path / ".envrc"
+    dotenv_path.write_bytes(b"export a=b\n")
+    first = direnv._direnv_file_hash(dotenv_path)
+    hits = direnv._cached_file_hash.cache_info().hits
+
+    result = direnv._direnv_file_hash(dotenv_path)
+
+    assert result == first
+    assert direnv._cached_file_hash.cache_info().hits == hits + 1
+
+
+@mock.patch.dict(os.environ, {"DIRENV_HASH": "xxh3"})
+def test_direnv_file_hash_xxh3(tmp_path):
+    xxhash = pytest.importorskip("xxhash")
+    dotenv_path = tmp_path / ".envrc"
+    dotenv_path.write_bytes(b"export a=b\n")
+    expected = xxhash.xxh3_128(f"{dotenv_path}\n".encode() + b"export a=b\n")
+
+    result = direnv._direnv_file_hash(dotenv_path)
+
+    assert result == expected.hexdigest()
+
+
+def test_is_allowed(tmp_path, allow_dir):
+    dotenv_path = tmp_path / ".envrc"
+    dotenv_path.write_bytes(b"export a=b\n")
+    assert not direnv._is_allowed(dotenv_path)
+
+    (allow_dir / direnv._direnv_file_hash(dotenv_path)).write_text(f"{dotenv_path}\n")
+    assert direnv._is_allowed(dotenv_path)
+
+    dotenv_path.write_bytes(b"export a=c\n")
+    assert not direnv._is_allowed(dotenv_path)
+
+
+def test_is_allowed_relative_allow_dir(tmp_path, monkeypatch):
+    # What expanduser returns without HOME nor a pwd entry.
+    monkeypatch.setattr("direnv._ALLOW_DIR", "~/.local/share/direnv/allow")
+    os.chdir(tmp_path)
+    allow_dir = tmp_path / "~" / ".local" / "share" / "direnv" / "allow"
+    allow_dir.mkdir(parents=True)
+    dotenv_path = tmp_path / ".envrc"
+    dotenv_path.write_bytes(b"export a=b\n")
+
+    (allow_dir / direnv._direnv_file_hash(dotenv_path)).write_text(f"{dotenv_path}\n")
+
+    assert not direnv._is_allowed(dotenv_path)
+
+
+def test_is_allowed_revoked_same_mtime(tmp_path, allow_dir):
+    dotenv_path = tmp_path / ".envrc"
+    dotenv_path.write_bytes(b"export a=b\n")
+    allowed_file_path = allow_dir / direnv._direnv_file_hash(dotenv_path)
+    allowed_file_path.write_text(f"{dotenv_path}\n")
+    stat = allow_dir.stat()
+    assert direnv._is_allowed(dotenv_path)
+
+    allowed_file_path.unlink()
+    # Simulate a revocation within the allow directory's timestamp granularity.
+    os.utime(allow_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert not direnv._is_allowed(dotenv_path)
+
+
+def test_is_allowed_through_symlink(tmp_path, allow_dir):
+    (tmp_path / "project").mkdir()
+    (tmp_path / "link").symlink_to(tmp_path / "project")
+    dotenv_path = tmp_path / "link" / ".envrc"
+    dotenv_path.write_bytes(b"export a=b\n")
+    real_path = tmp_path / "project" / ".envrc"
+
+    (allow_dir / direnv._direnv_file_hash(dotenv_path)).write_text(f"{real_path}\n")
+
+    assert direnv._is_allowed(dotenv_path)
+
+
+def test_is_allowed_xxh3(tmp_path, monkeypatch, allow_dir):
+    # Any hashlib-like constructor stands in for xxhash, which is optional.
+    monkeypatch.setattr("direnv.xxhash", types.SimpleNamespace(xxh3_128=hashlib.md5))
+    monkeypatch.setenv("DIRENV_HASH", "xxh3")
+    allow_xxh3_dir = tmp_path / "allow_xxh3"
+    allow_xxh3_dir.mkdir()
+    monkeypatch.setattr("direnv._ALLOW_XXH3_DIR", str(allow_xxh3_dir))
+    dotenv_path = tmp_path / ".envrc"
+    dotenv_path.write_bytes(b"export a=b\n")
+    expected = hashlib.md5(f"{dotenv_path}\n".encode() + b"export a=b\n")
+    assert direnv._direnv_file_hash(dotenv_path) == expected.hexdigest()
+
+    # Entries recorded by `direnv allow` don't apply to xxh3 hashes.
+    (allow_dir / expected.hexdigest()).write_text(f"{dotenv_path}\n")
+    assert not direnv._is_allowed(dotenv_path)
+
+    (allow_xxh3_dir / expected.hexdigest()).write_text(f"{dotenv_path}\n")
+    assert direnv._is_allowed(dotenv_path)
+
+
+def test_is_allowed_path_became_symlink(tmp_path, allow_dir):
+    (tmp_path / "other").mkdir()
+    (tmp_path / "link").symlink_to(tmp_path / "other")
+    dotenv_path = tmp_path / "link" / ".envrc"
+    dotenv_path.write_bytes(b"export a=b\n")
+
+    # Allowed as a real path, before "link" became a symlink to "other".
+    (allow_dir / direnv._direnv_file_hash(dotenv_path)).write_text(f"{dotenv_path}\n")
+
+    assert not direnv._is_allowed(dotenv_path)
+
+
+def test_parse_bash_env(caplog):
+    stream = [
+        b'declare -x a="b"\n',
+        b'declare -fx f\n',
+        b'declare -x c\n',
+        b'declare -x d="e=f"\n',
+        b'declare -x e="f \\"g\\" \\\\ \\$h \\`i\\` \\n"\n',
+    ]
+
+    with caplog.at_level(logging.WARNING):
+        result = list(direnv._parse_bash_env(stream))
+
+    assert result == [
+        ("a", "b"),
+        ("c", None),
+        ("d", "e=f"),
+        ("e", 'f "g" \\ $h `i` \\n'),
+    ]
+    assert "line 2: 'declare -fx f'" in caplog.text
+
+
 @mock.patch.dict(os.environ, {}, clear=True)
 def test_load_direnv_existing_file(dotenv_path, direnv_allow):
     dotenv_path.write_text("export a=b")
@@ -157,6 +370,41 @@ def test_load_direnv_in_current_dir(tmp_path, direnv_allow):
     assert result.stdout.strip() == "b"
 
 
+def test_load_direnv_in_script_dir_over_current_dir(tmp_path):
+    script_dir = tmp_path / "script"
+    script_dir.mkdir()
+    (script_dir / ".envrc").write_bytes(b"export a=b")
+    cwd = tmp_path / "cwd"
+    cwd.mkdir()
+    (cwd / ".envrc").write_bytes(b"export a=c")
+    code_path = script_dir / "code.py"
+    sys_path = ":".join(sys.path)
+    code_path.write_text(
+        textwrap.dedent(
+            f"""
+            import sys
+            sys.path = '{sys_path}'.split(':')
+            import direnv
+            import os
+            from unittest import mock
+            with mock.patch('direnv._is_allowed', lambda _: True):
+                direnv.load_direnv(verbose=True)
+                print(os.environ.get('a'))
+    """
+        )
+    )
+    result = subprocess.run(
+        [sys.executable, '-I', str(code_path)],
+        capture_output=True,
+        cwd=str(cwd),
+        env={},
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{result.stderr}")
+    assert result.stdout.strip() == "b"
+
+
 def test_direnv_values_file(dotenv_path, direnv_allow):
     dotenv_path.write_text("export a=b")
 
@@ -165,6 +413,15 @@ def test_direnv_values_file(dotenv_path, direnv_allow):
     assert result == {"a": "b"}
 
 
+def test_direnv_values_source_error(dotenv_path, direnv_allow):
+    dotenv_path.write_text("echo oops >&2\nfalse")
+
+    with pytest.raises(RuntimeError) as excinfo:
+        direnv.direnv_values(dotenv_path)
+
+    assert "oops" in str(excinfo.value)
+
+
 def test_direnv_values_string_io(direnv_allow):
     env, string, interpolate, expected = {"b": "c"}, "a=$b", False, {"a": "$b"}
     with mock.patch.dict(os.environ, env, clear=True):